@@ -0,0 +1,166 @@
+# Per-room statistics over the archived day files in db/, one day file per worker process.
+#
+#   python analytics.py --since 2025-11-01 --until 2026-03-31 > season.csv
+#   python analytics.py --summary
+#
+# duty_cycle            fraction of recorded time the boiler was ON
+# heat_up_rate          room temperature change while the boiler was ON, in C/hour
+# missing_data_ratio    fraction of the per-minute ticks between two rollovers without a row for the room.
+#                       A room seen anywhere in the range but without a table in a file is reported with zero rows.
+# pipe_out_overshoot    maximum pipe out above --pipe-out-high-limit, and minutes spent above it
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import os
+import sys
+from control_rules import DEFAULT_PIPE_OUT_HIGH_LIMIT
+from database import find_archived_db_files, read_room_columns, DB_ROLLOVER_TIME
+
+
+# Rows further apart than this are a gap in the recording
+ANALYTICS_MAX_TICK_SECONDS = 90
+
+# An archived file holds the ticks of one day between two rollovers
+ANALYTICS_DAY_MINUTES = 24 * 60
+
+DAY_COLUMNS = ('day', 'room')
+SUM_COLUMNS = ('recorded_rows', 'recorded_minutes', 'expected_minutes', 'boiler_on_minutes', 'heat_up_degrees', 'heat_up_minutes', 'pipe_out_overshoot_minutes')
+MAX_COLUMNS = ('pipe_out_overshoot_max',)
+RATIO_COLUMNS = ('duty_cycle', 'heat_up_rate', 'missing_data_ratio')
+
+
+def _room_sums(columns, pipe_out_high_limit):
+    recorded_seconds = 0
+    boiler_on_seconds = 0
+    heat_up_degrees = 0.0
+    heat_up_seconds = 0
+    overshoot_seconds = 0
+    overshoot_max = 0.0
+
+    previous = None
+    for t, current, pipe_out, boiler_state in zip(columns['date'], columns['current_temperature'], columns['current_pipe_out'], columns['boiler_state']):
+        if previous is not None:
+            previous_t, previous_current, previous_pipe_out, previous_boiler_state = previous
+            dt = t - previous_t
+            if dt <= ANALYTICS_MAX_TICK_SECONDS:
+                recorded_seconds += dt
+                if previous_boiler_state:
+                    boiler_on_seconds += dt
+                    if current is not None and previous_current is not None:
+                        heat_up_degrees += current - previous_current
+                        heat_up_seconds += dt
+                if previous_pipe_out is not None and previous_pipe_out > pipe_out_high_limit:
+                    overshoot_seconds += dt
+
+        if pipe_out is not None:
+            overshoot_max = max(overshoot_max, pipe_out - pipe_out_high_limit)
+
+        previous = (t, current, pipe_out, boiler_state)
+
+    return recorded_seconds / 60, boiler_on_seconds / 60, heat_up_degrees, heat_up_seconds / 60, overshoot_seconds / 60, overshoot_max
+
+
+def _expected_minutes(db_file_path):
+    # From the rollover window, not from the rows, so that an outage at the start or the end of the day counts as missing
+    if os.path.basename(db_file_path) != 'thermostat.db':
+        return ANALYTICS_DAY_MINUTES
+
+    now = datetime.datetime.now()
+    last_rollover = datetime.datetime.combine(now.date(), DB_ROLLOVER_TIME)
+    if last_rollover > now:
+        last_rollover -= datetime.timedelta(days=1)
+
+    return (now - last_rollover).total_seconds() / 60
+
+
+def analyse_day_file(db_file_path, pipe_out_high_limit):
+    # Returns (day, expected minutes, rows of the rooms with a table in the file)
+    room_columns = read_room_columns(db_file_path)
+
+    expected_minutes = _expected_minutes(db_file_path)
+    day = os.path.splitext(os.path.basename(db_file_path))[0].partition('_')[2] or 'current'
+
+    rows = []
+    for room_name, columns in sorted(room_columns.items()):
+        recorded_minutes, boiler_on_minutes, heat_up_degrees, heat_up_minutes, overshoot_minutes, overshoot_max = _room_sums(columns, pipe_out_high_limit)
+        rows.append((day, room_name, len(columns['date']), recorded_minutes, expected_minutes, boiler_on_minutes, heat_up_degrees, heat_up_minutes, overshoot_minutes, overshoot_max))
+
+    return day, expected_minutes, rows
+
+
+def fill_missing_rooms(day_files):
+    # A room is only inserted while its data is not missing, so a room that was offline all day has no table in the file
+    room_names = sorted({row[1] for day, expected_minutes, rows in day_files for row in rows})
+
+    all_rows = []
+    for day, expected_minutes, rows in day_files:
+        day_rows = {row[1]: row for row in rows}
+        all_rows.extend(day_rows.get(room_name, (day, room_name, 0, 0, expected_minutes, 0, 0.0, 0, 0, 0.0)) for room_name in room_names)
+
+    return all_rows
+
+
+def _ratios(recorded_rows, recorded_minutes, expected_minutes, boiler_on_minutes, heat_up_degrees, heat_up_minutes):
+    duty_cycle = boiler_on_minutes / recorded_minutes if recorded_minutes else None
+    heat_up_rate = heat_up_degrees * 60 / heat_up_minutes if heat_up_minutes else None
+    # From the row count: one missing row makes a single 2 minute interval, which recorded_minutes drops as a whole
+    missing_data_ratio = max(0.0, 1 - recorded_rows / expected_minutes) if expected_minutes else None
+
+    return duty_cycle, heat_up_rate, missing_data_ratio
+
+
+def summarise(rows):
+    # Sums are added up per room, ratios are computed from the totals rather than averaged per day
+    totals = {}
+    for row in rows:
+        day, room_name = row[:2]
+        sums = row[2:2 + len(SUM_COLUMNS)]
+        overshoot_max = row[-1]
+
+        first_day, last_day, total_sums, total_overshoot_max = totals.get(room_name, (day, day, (0,) * len(SUM_COLUMNS), overshoot_max))
+        totals[room_name] = (min(first_day, day), max(last_day, day), tuple(a + b for a, b in zip(total_sums, sums)), max(total_overshoot_max, overshoot_max))
+
+    return [('{}..{}'.format(first_day, last_day), room_name) + sums + (overshoot_max,) for room_name, (first_day, last_day, sums, overshoot_max) in sorted(totals.items())]
+
+
+def _format_row(row):
+    sums = row[2:2 + len(SUM_COLUMNS)]
+    ratios = _ratios(*sums[:6])
+
+    return row[:2] + tuple(round(value, 2) for value in sums) + (round(row[-1], 2),) + tuple('' if value is None else round(value, 4) for value in ratios)
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Per-room statistics over the archived day files')
+    parser.add_argument('--db-dir', default='db')
+    parser.add_argument('--since', type=_date, default=None, help='YYYY-MM-DD of the first day file')
+    parser.add_argument('--until', type=_date, default=None, help='YYYY-MM-DD of the last day file')
+    parser.add_argument('--include-current', action='store_true', help='Also analyse the live thermostat.db')
+    parser.add_argument('--pipe-out-high-limit', type=float, default=DEFAULT_PIPE_OUT_HIGH_LIMIT)
+    parser.add_argument('--summary', action='store_true', help='One row per room over all days instead of one row per day and room')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, all cores by default')
+    args = parser.parse_args(argv)
+
+    db_file_paths = find_archived_db_files(args.db_dir, args.since, args.until, args.include_current)
+    if not db_file_paths:
+        parser.error("No day files found in {}".format(args.db_dir))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        rows = fill_missing_rooms(list(executor.map(analyse_day_file, db_file_paths, [args.pipe_out_high_limit] * len(db_file_paths))))
+
+    if args.summary:
+        rows = summarise(rows)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(DAY_COLUMNS + SUM_COLUMNS + MAX_COLUMNS + RATIO_COLUMNS)
+    for row in rows:
+        writer.writerow(_format_row(row))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+
+CONTROL_CHANNEL_ADDRESS = ('127.0.0.1', 6001)
+
+# A new random authkey is written here by every control process start. Only the owner can read it.
+CONTROL_CHANNEL_AUTHKEY_FILE = os.path.join('db', 'control.key')
+
+# Seconds to wait for the reply. Below gunicorn's default 30 s worker timeout, so a wedged control process
+# turns into an error response instead of a killed worker.
+CONTROL_CHANNEL_TIMEOUT = 20
+
+
+class ControlChannelError(Exception):
+    pass
+
+
+class ControlCommandError(ControlChannelError):
+    # The control process was reached but the command handler failed, e.g. on an invalid form value
+    pass
+
+
+# Messages are JSON sent with send_bytes()/recv_bytes(). Connection.send()/recv() would unpickle whatever the peer sends.
+def _send_message(conn, message):
+    conn.send_bytes(json.dumps(message).encode('utf-8'))
+
+
+def _recv_message(conn):
+    return json.loads(conn.recv_bytes().decode('utf-8'))
+
+
+def _write_authkey(authkey_file):
+    try:
+        os.makedirs(os.path.dirname(authkey_file))
+    except FileExistsError:
+        pass
+
+    authkey = os.urandom(32)
+
+    # Recreated rather than truncated so that the 0600 mode also applies when an older file exists
+    try:
+        os.remove(authkey_file)
+    except FileNotFoundError:
+        pass
+
+    fd = os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+
+    return authkey
+
+
+class ControlServer:
+    def __init__(self, handlers, address=CONTROL_CHANNEL_ADDRESS, authkey_file=CONTROL_CHANNEL_AUTHKEY_FILE):
+        self._logger = logging.getLogger("thermostat")
+
+        self._handlers = handlers
+        self._address = address
+        self._authkey_file = authkey_file
+        self._listener = None
+
+    def open(self):
+        self._listener = Listener(self._address, authkey=_write_authkey(self._authkey_file))
+
+    def serve_forever(self):
+        while self._listener:
+            try:
+                conn = self._listener.accept()
+            except AuthenticationError:
+                self._logger.info("ControlServer: rejected a connection with a wrong authkey")
+                continue
+            except OSError:
+                if self._listener is None:
+                    break
+                self._logger.info("ControlServer: accept failed\n{}".format(traceback.format_exc()))
+                continue
+
+            # One thread per command so that a slow command never holds up the next one
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn):
+        with conn:
+            try:
+                command, payload = _recv_message(conn)
+            except (EOFError, OSError, ValueError, TypeError):
+                return
+
+            try:
+                result = (True, self._handlers[command](payload))
+            except Exception as e:
+                self._logger.info("ControlServer: command {} failed\n{}".format(command, traceback.format_exc()))
+                result = (False, "{}: {}".format(type(e).__name__, e))
+
+            try:
+                _send_message(conn, result)
+            except (OSError, ValueError, TypeError):
+                pass
+
+    def close(self):
+        listener = self._listener
+        self._listener = None
+
+        if listener:
+            listener.close()
+
+
+class ControlClient:
+    def __init__(self, address=CONTROL_CHANNEL_ADDRESS, authkey_file=CONTROL_CHANNEL_AUTHKEY_FILE, timeout=CONTROL_CHANNEL_TIMEOUT):
+        self._address = address
+        self._authkey_file = authkey_file
+        self._timeout = timeout
+
+    def send_command(self, command, payload=None):
+        # The authkey is read per command because it changes whenever the control process restarts.
+        # A new connection per command also keeps the client safe to use from forked WSGI workers and threads.
+        try:
+            with open(self._authkey_file, 'rb') as f:
+                authkey = f.read()
+
+            with Client(self._address, authkey=authkey) as conn:
+                _send_message(conn, (command, payload))
+                if not conn.poll(self._timeout):
+                    raise ControlChannelError("Control process did not answer {} within {} seconds".format(command, self._timeout))
+                ok, result = _recv_message(conn)
+        except (EOFError, OSError, AuthenticationError) as e:
+            raise ControlChannelError("Control process is not reachable: {}".format(e))
+
+        if not ok:
+            raise ControlCommandError(result)
+
+        return result
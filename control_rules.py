@@ -0,0 +1,25 @@
+import datetime
+
+
+# Kept free of Flask, GPIO and scheduler imports so the rules can be replayed offline (see replay.py)
+
+DEFAULT_BOILER_STATE_CHANGE_DELAY = datetime.timedelta(minutes=5)
+DEFAULT_MAX_BOILER_ON_TIME = datetime.timedelta(minutes=15)
+DEFAULT_PIPE_OUT_HIGH_LIMIT = 35.0
+DEFAULT_PIPE_OUT_LOW_LIMIT = 31.0
+
+TARGET_HIGH_MARGIN = 0.2
+
+
+# time_passed_after_boiler_state_change and the time limits may be timedeltas or seconds, as long as they agree
+def should_turn_off_boiler(current, target, pipe_out, time_passed_after_boiler_state_change, pipe_out_high_limit, max_boiler_on_time):
+    return pipe_out >= pipe_out_high_limit or \
+           current >= target + TARGET_HIGH_MARGIN or \
+           time_passed_after_boiler_state_change >= max_boiler_on_time
+
+
+def should_turn_on_boiler(current, target, pipe_out, data_missing, time_passed_after_boiler_state_change, pipe_out_low_limit, boiler_state_change_delay):
+    return pipe_out < pipe_out_low_limit and \
+           current < target and \
+           time_passed_after_boiler_state_change >= boiler_state_change_delay and \
+           data_missing == 0
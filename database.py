@@ -2,9 +2,63 @@ import logging
 import traceback
 import datetime
 import os
+import re
 import sqlite3
-from collections import OrderedDict
-from sensor_map import *
+import pickle
+import threading
+import collections
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Daily time of ThermostatDatabase.rollover(). An archived file holds the day up to this time.
+DB_ROLLOVER_TIME = datetime.time(8, 59, 45)
+
+
+ROOM_COLUMNS = ('date',
+                'current_temperature',
+                'current_humidity',
+                'current_pipe_in',
+                'current_pipe_out',
+                'target_temperature',
+                'boiler_state',
+                'data_missing')
+
+
+def find_archived_db_files(db_file_directory_name='db', since=None, until=None, include_current=False):
+    # Archived files are named thermostat_YYYY-MM-DD.db by ThermostatDatabase.rollover()
+    db_file_paths = []
+    for file in sorted(os.listdir(db_file_directory_name)):
+        match = re.fullmatch(r'thermostat_(\d{4}-\d{2}-\d{2})\.db', file)
+        if not match:
+            continue
+
+        date = datetime.datetime.strptime(match.group(1), '%Y-%m-%d').date()
+        if (since is None or date >= since) and (until is None or date <= until):
+            db_file_paths.append(os.path.join(db_file_directory_name, file))
+
+    if include_current and os.path.exists(os.path.join(db_file_directory_name, 'thermostat.db')):
+        db_file_paths.append(os.path.join(db_file_directory_name, 'thermostat.db'))
+
+    return db_file_paths
+
+
+def read_room_columns(db_file_path):
+    # Returns {room_name: {column_name: list}}. 'date' is converted to integer seconds by sqlite, not by strptime.
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_file_path), uri=True)
+    try:
+        room_names = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+
+        room_columns = {}
+        for room_name in room_names:
+            command = """SELECT CAST(strftime('%s', date) AS INTEGER), {columns:} FROM {room_name:} ORDER BY date""".format(columns=', '.join(ROOM_COLUMNS[1:]), room_name=room_name)
+            rows = conn.execute(command).fetchall()
+            columns = list(zip(*rows)) if rows else [()] * len(ROOM_COLUMNS)
+            room_columns[room_name] = {column_name: list(values) for column_name, values in zip(ROOM_COLUMNS, columns)}
+    finally:
+        conn.close()
+
+    return room_columns
 
 
 class ThermostatDatabase:
@@ -86,94 +140,212 @@ class ThermostatDatabase:
         self._conn.close()
 
 
-class ThermostatDatabaseStream:
+# The control process publishes a pickled snapshot of thermostat_states after every change.
+# WSGI worker processes only read the latest snapshot, so they never touch the control loop or its lock.
+class ThermostatStateStore:
     def __init__(self):
-        self._last_sensor_data_sync_time = {sensor_name: None for sensor_name in SENSOR_NAMES}
+        self._logger = logging.getLogger("thermostat")
+
         self._conn = None
-        self._cur = None
+        self._lock = threading.Lock()
+
+        self._db_file_directory_name = 'db'
+        self._db_file_name = 'state'
+        self._db_file_ext = '.db'
+        self._db_file_path = os.path.join(self._db_file_directory_name, self._db_file_name + self._db_file_ext)
+
+    def open(self):
+        try:
+            os.makedirs(self._db_file_directory_name)
+        except FileExistsError:
+            pass
+
+        self._conn = sqlite3.connect(self._db_file_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS states(id INTEGER PRIMARY KEY NOT NULL, data BLOB NOT NULL)")
+
+    def publish(self, states):
+        data = pickle.dumps(states, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO states VALUES (0, ?)", (sqlite3.Binary(data),))
+
+    def load(self):
+        # A short lived read-only connection per call is cheap and safe across forked workers
+        conn = sqlite3.connect('file:{}?mode=ro'.format(self._db_file_path), uri=True)
+        try:
+            row = conn.execute("SELECT data FROM states WHERE id = 0").fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            raise LookupError("No controller state has been published to {}".format(self._db_file_path))
+
+        return pickle.loads(row[0])
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+# Follows the room tables of db/thermostat.db. Each table is read from a rowid watermark, so every call only
+# fetches the rows inserted since the previous call, in batches, as {room_name: {column_name: list}}.
+# 'date' is returned as integer seconds, the same as read_room_columns().
+# close_database() returns {room_name: datetime of the last row read}, which get_initial_data() accepts to resume.
+class ThermostatDatabaseStream:
+    def __init__(self, batch_size=1000):
+        self._batch_size = batch_size
+        self._watermarks = {}
+        self._last_sync_times = {}
+        self._inode = None
 
         self._db_file_directory_name = 'db'
         self._db_file_name = 'thermostat'
         self._db_file_ext = '.db'
         self._db_file_path = os.path.join(self._db_file_directory_name, self._db_file_name + self._db_file_ext)
 
-    def _build_db_file_paths(self, since):
-        today0 = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        since0 = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    def _connect(self, db_file_path):
+        # The connection is never kept between calls. A reader holding the file open across
+        # ThermostatDatabase.rollover() would keep the WAL of the renamed file alive under the live name.
+        return sqlite3.connect('file:{}?mode=ro'.format(db_file_path), uri=True)
+
+    def _read_new_rows(self, conn, watermarks, since=None):
+        # since: {room_name: datetime}. Rows up to it are skipped by moving the watermark past them.
+        room_names = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+
+        room_columns = {}
+        for room_name in room_names:
+            watermark = watermarks.get(room_name, 0)
+            if since is not None:
+                # Rows are inserted in time order, so everything after this rowid is newer than 'since'
+                command = """SELECT COALESCE(MAX(rowid), 0) FROM {room_name:} WHERE date <= ?""".format(room_name=room_name)
+                watermark = max(watermark, conn.execute(command, (since[room_name].strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()[0])
+
+            command = """SELECT rowid, CAST(strftime('%s', date) AS INTEGER), {columns:} FROM {room_name:} WHERE rowid > ? ORDER BY rowid LIMIT ?""".format(columns=', '.join(ROOM_COLUMNS[1:]), room_name=room_name)
+            columns = {column_name: [] for column_name in ROOM_COLUMNS}
+            while True:
+                rows = conn.execute(command, (watermark, self._batch_size)).fetchall()
+                if not rows:
+                    break
 
-        db_file_names = []
-        while since0 < today0:
-            db_file_name = os.path.join(self._db_file_directory_name, '{file_name:}_{date:}{file_ext:}'.format(file_name=self._db_file_name, date=since0.strftime('%Y-%m-%d'), file_ext=self._db_file_ext))
-            db_file_names.append(db_file_name)
-            since0 += datetime.timedelta(days=1)
+                watermark = rows[-1][0]
+                for column_name, values in zip(ROOM_COLUMNS, list(zip(*rows))[1:]):
+                    columns[column_name].extend(values)
 
-        db_file_names.append(self._db_file_path)
+                if len(rows) < self._batch_size:
+                    break
 
-        return db_file_names
+            watermarks[room_name] = watermark
+            room_columns[room_name] = columns
+
+            if columns['date']:
+                self._last_sync_times[room_name] = _EPOCH + datetime.timedelta(seconds=columns['date'][-1])
+
+        return room_columns
+
+    def _read_file(self, db_file_path, watermarks, since=None):
+        conn = self._connect(db_file_path)
+        try:
+            return self._read_new_rows(conn, watermarks, since)
+        finally:
+            conn.close()
+
+    def _find_rolled_over_file(self):
+        # Only runs once per rollover. The archived file is the one that kept the inode of the followed file.
+        for db_file_path in find_archived_db_files(self._db_file_directory_name):
+            if os.stat(db_file_path).st_ino == self._inode:
+                return db_file_path
+
+        return None
+
+    def _connect_live_file(self):
+        # Returns (connection, inode) of the live file, checking that no rollover happened between stat() and connect()
+        while True:
+            inode = os.stat(self._db_file_path).st_ino
+            conn = self._connect(self._db_file_path)
+            try:
+                if os.stat(self._db_file_path).st_ino == inode:
+                    return conn, inode
+            except FileNotFoundError:
+                conn.close()
+                raise
+
+            conn.close()
 
     def get_data(self):
-        sensor_data_collection = {}
-        for sensor_name in SENSOR_NAMES:
-            sensor_data, self._last_sensor_data_sync_time[sensor_name] = self._read_sensor_data(sensor_name, self._last_sensor_data_sync_time[sensor_name])
-            sensor_data_collection[sensor_name] = sensor_data
+        room_columns = {}
 
-        return sensor_data_collection
+        try:
+            conn, inode = self._connect_live_file()
+        except (FileNotFoundError, sqlite3.OperationalError):
+            # Between the rename and the first insert of ThermostatDatabase.rollover() there is no live file
+            return room_columns
+
+        try:
+            if self._inode is not None and inode != self._inode:
+                # Drain what was written to the followed file before it was renamed, then start over on the new one
+                rolled_over_file = self._find_rolled_over_file()
+                if rolled_over_file:
+                    _extend_room_columns(room_columns, self._read_file(rolled_over_file, self._watermarks))
+
+                self._watermarks = {}
+
+            self._inode = inode
+            _extend_room_columns(room_columns, self._read_new_rows(conn, self._watermarks))
+        finally:
+            conn.close()
+
+        return room_columns
 
     def get_initial_data(self, last_db_sync_times):
+        # Accepts a datetime, or the {room_name: datetime} returned by close_database().
+        # Archived files are only read once. The watermarks then follow the live file.
         if isinstance(last_db_sync_times, dict):
             since = min(last_db_sync_times.values())
+            room_since = collections.defaultdict(lambda: since, last_db_sync_times)
         else:
             since = last_db_sync_times
-            last_db_sync_times = {sensor_name: since for sensor_name in SENSOR_NAMES}
-
-        db_file_names = self._build_db_file_paths(since)
-
-        today_db_file_name = os.path.join(self._db_file_directory_name, '{file_name:}{file_ext:}'.format(file_name=self._db_file_name, file_ext=self._db_file_ext))
+            room_since = collections.defaultdict(lambda: since)
 
-        sensor_data_collection = {sensor_name: OrderedDict() for sensor_name in SENSOR_NAMES}
+        room_columns = {}
+        self._last_sync_times = {}
 
-        for db_file_name in db_file_names:
-            if os.path.exists(db_file_name):
-                self._conn = sqlite3.connect('file:{}?mode=ro'.format(db_file_name), uri=True)
-                self._cur = self._conn.cursor()
+        for db_file_path in find_archived_db_files(self._db_file_directory_name, since.date()):
+            _extend_room_columns(room_columns, self._read_file(db_file_path, {}, room_since))
 
-                for sensor_name in SENSOR_NAMES:
-                    sensor_data, self._last_sensor_data_sync_time[sensor_name] = self._read_sensor_data(sensor_name, last_db_sync_times[sensor_name])
-                    sensor_data_collection[sensor_name].update(sensor_data)
-
-                if db_file_name != today_db_file_name:
-                    self._cur.close()
-                    self._conn.close()
-
-        return sensor_data_collection
-
-    def _read_sensor_data(self, sensor_name, since):
-        command = '''SELECT * FROM {sensor_name:} WHERE date > strftime('%Y-%m-%d %H:%M:%S', '{since:}') ORDER BY date;'''.format(sensor_name=sensor_name, since=since.strftime('%Y-%m-%d %H:%M:%S'))
+        self._watermarks = {}
+        self._inode = None
+        try:
+            conn, self._inode = self._connect_live_file()
+        except (FileNotFoundError, sqlite3.OperationalError):
+            return room_columns
 
-        t = since
-        sensor_data = OrderedDict()
-        for t, temperature, humidity in self._cur.execute(command):
-            t = datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S')
-            if t > since:
-                sensor_data[t] = (temperature, humidity)
+        try:
+            _extend_room_columns(room_columns, self._read_new_rows(conn, self._watermarks, room_since))
+        finally:
+            conn.close()
 
-        return sensor_data, t
+        return room_columns
 
     def close_database(self):
         self.quit()
 
-        last_sensor_data_sync_time = self._last_sensor_data_sync_time
+        last_sync_times = self._last_sync_times
 
-        self._last_sensor_data_sync_time = {sensor_name: None for sensor_name in SENSOR_NAMES}
+        self._watermarks = {}
+        self._last_sync_times = {}
+        self._inode = None
 
-        return last_sensor_data_sync_time
+        return last_sync_times
 
     def quit(self):
-        if self._cur:
-            self._cur.close()
-            self._cur = None
+        # Nothing is kept open between reads
+        pass
 
-        if self._conn:
-            self._conn.close()
-            self._conn = None
 
+def _extend_room_columns(room_columns, new_room_columns):
+    for room_name, new_columns in new_room_columns.items():
+        columns = room_columns.setdefault(room_name, {column_name: [] for column_name in ROOM_COLUMNS})
+        for column_name, values in new_columns.items():
+            columns[column_name].extend(values)
@@ -7,14 +7,23 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.events import EVENT_JOB_ERROR
 import logging
 from logging.handlers import TimedRotatingFileHandler
-from database import ThermostatDatabase
+from database import ThermostatDatabase, ThermostatStateStore, DB_ROLLOVER_TIME
+from control_channel import ControlServer, ControlClient, ControlChannelError, ControlCommandError
+from control_rules import (should_turn_off_boiler, should_turn_on_boiler,
+                           DEFAULT_BOILER_STATE_CHANGE_DELAY, DEFAULT_MAX_BOILER_ON_TIME, DEFAULT_PIPE_OUT_HIGH_LIMIT, DEFAULT_PIPE_OUT_LOW_LIMIT)
+from thermal_model import ThermalModel
+from journal import EventJournal, EVENT_SENSOR_READ, EVENT_DECISION, EVENT_ACTUATION, EVENT_CONFIG_CHANGE, EVENT_SENSOR_HEALTH
+from sensor_health import SensorHealthMonitor
+from sensor_map import SENSOR_RELATION
+from profiling import profile_toggle, tracemalloc_diff, JobRunRecorder, PROFILE_DEFAULT_INTERVAL, PROFILE_MAX_SECONDS
 import os
 import signal
 import datetime
 import time
 import requests
+import sqlite3
 import concurrent.futures
-from pprint import pprint, pformat
+import traceback
 
 
 THERMOSTAT_OFF_TEMPERATURE = 5.0
@@ -44,6 +53,9 @@ STATE_AUTO_ON_TIME = "STATE_AUTO_ON_TIME"
 STATE_AUTO_ON_TARGET = "STATE_AUTO_ON_TARGET"
 STATE_AUTO_OFF = "STATE_AUTO_OFF"
 STATE_AUTO_OFF_TIME = "STATE_AUTO_OFF_TIME"
+STATE_AUTO_ON_LEAD_MINUTES = "STATE_AUTO_ON_LEAD_MINUTES"
+STATE_AUTO_ON_PREHEAT_FOR = "STATE_AUTO_ON_PREHEAT_FOR"
+STATE_SENSOR_TRUSTED = "STATE_SENSOR_TRUSTED"
 
 
 CONFIGURATIONS = "CONFIGURATIONS"
@@ -56,10 +68,10 @@ CONFIG_PIPE_OUT_LOW_LIMIT = "CONFIG_PIPE_OUT_LOW_LIMIT"
 
 
 default_configurations = {
-    CONFIG_BOILER_STATE_CHANGE_DELAY:   datetime.timedelta(minutes=5),
-    CONFIG_MAX_BOILER_ON_TIME:          datetime.timedelta(minutes=15),
-    CONFIG_PIPE_OUT_HIGH_LIMIT:         35.0,
-    CONFIG_PIPE_OUT_LOW_LIMIT:          31.0
+    CONFIG_BOILER_STATE_CHANGE_DELAY:   DEFAULT_BOILER_STATE_CHANGE_DELAY,
+    CONFIG_MAX_BOILER_ON_TIME:          DEFAULT_MAX_BOILER_ON_TIME,
+    CONFIG_PIPE_OUT_HIGH_LIMIT:         DEFAULT_PIPE_OUT_HIGH_LIMIT,
+    CONFIG_PIPE_OUT_LOW_LIMIT:          DEFAULT_PIPE_OUT_LOW_LIMIT
 }
 
 
@@ -78,7 +90,10 @@ default_room_state = {
     STATE_AUTO_ON_TIME:         '20:00',
     STATE_AUTO_ON_TARGET:       24.5,
     STATE_AUTO_OFF:             False,
-    STATE_AUTO_OFF_TIME:        '08:00'
+    STATE_AUTO_OFF_TIME:        '08:00',
+    STATE_AUTO_ON_LEAD_MINUTES: None,
+    STATE_AUTO_ON_PREHEAT_FOR:  None,
+    STATE_SENSOR_TRUSTED:       True
 }
 
 
@@ -91,6 +106,14 @@ thermostat_states = {
 }
 
 
+thermal_models = {room: ThermalModel() for room in ROOMS}
+sensor_health = SensorHealthMonitor()
+
+
+PIPE_IN_SENSOR = 'IN_PIPE_SENSOR'
+ROOM_SENSORS = dict(zip(ROOMS, SENSOR_RELATION))    # room: (room sensor, pipe out sensor). SENSOR_RELATION follows the ROOMS order.
+
+
 temperature_servers = {
     PIPES_BOILER:   "http://192.168.50.32/temperature",
     ROOM_LIVING:    "http://192.168.50.34/temperature",
@@ -114,6 +137,10 @@ scheduler = None
 app = Flask(__name__)
 lock = threading.Lock()
 thermostat_db = None
+state_store = None
+journal = EventJournal()
+job_run_recorder = JobRunRecorder()
+control_client = None   # Set only in WSGI worker processes. Commands are then forwarded to the control process.
 
 
 max_data_missing = 0
@@ -153,12 +180,48 @@ def db_update():
 
 def periodic_task():
     read_temperatures()
+    update_sensor_health()
+    update_thermal_models()
+    preheat_task()
     db_update()
     temperature_keeping_task()
+    publish_states()
+
+
+def publish_states():
+    if state_store:
+        state_store.publish(thermostat_states)
+
+
+def init_worker():
+    global log
+    global state_store
+    global control_client
+
+    log = logging.getLogger(__name__)
+    state_store = ThermostatStateStore()
+    control_client = ControlClient()
+
+
+def run_control_command(command, payload=None):
+    if control_client:
+        return control_client.send_command(command, payload)
+
+    # Same errors as through the control channel
+    try:
+        return control_commands[command](payload)
+    except Exception as e:
+        log.info("Command {} failed\n{}".format(command, traceback.format_exc()))
+        raise ControlCommandError("{}: {}".format(type(e).__name__, e))
 
-def read_temperatures():
-    log.info("TASK - Updating sensor data")
 
+def current_states():
+    if control_client:
+        return state_store.load()
+
+    return thermostat_states
+
+def read_temperatures():
     global max_data_missing
     global thermostat_states
 
@@ -190,6 +253,12 @@ def read_temperatures():
                 thermostat_states[room][STATE_PIPE_IN]              = temperatures[PIPES_BOILER]['PIPE_IN_MAIN']['temperature']
                 thermostat_states[room][STATE_PIPE_OUT]             = temperatures[PIPES_BOILER][OUT_PIPE_NAME[room]]['temperature']
                 thermostat_states[room][STATE_DATA_MISSING_COUNT]   = 0
+                journal.record(EVENT_SENSOR_READ,
+                               room=room,
+                               temperature=thermostat_states[room][STATE_TEMPERATURE],
+                               humidity=thermostat_states[room][STATE_HUMIDITY],
+                               pipe_in=thermostat_states[room][STATE_PIPE_IN],
+                               pipe_out=thermostat_states[room][STATE_PIPE_OUT])
             else:
                 thermostat_states[room][STATE_DATA_MISSING_COUNT] += 1
                 max_data_missing = max(max_data_missing, thermostat_states[room][STATE_DATA_MISSING_COUNT])
@@ -197,7 +266,94 @@ def read_temperatures():
             thermostat_states[room][STATE_DATA_MISSING_COUNT] += 1
             max_data_missing = max(max_data_missing, thermostat_states[room][STATE_DATA_MISSING_COUNT])
 
-    log.info("Max data missing: " + str(max_data_missing) + " " + pformat([thermostat_states[room][STATE_DATA_MISSING_COUNT] for room in ROOMS]))
+        if thermostat_states[room][STATE_DATA_MISSING_COUNT] != 0:
+            journal.record(EVENT_SENSOR_READ, room=room, missing=thermostat_states[room][STATE_DATA_MISSING_COUNT], max_missing=max_data_missing)
+
+
+def update_sensor_health():
+    global thermostat_states
+
+    pipe_in_updated = False
+    any_boiler_on = any(thermostat_states[room][STATE_BOILER] for room in ROOMS)
+
+    for room in ROOMS:
+        if thermostat_states[room][STATE_DATA_MISSING_COUNT] != 0:
+            continue
+
+        room_sensor, pipe_out_sensor = ROOM_SENSORS[room]
+        t = thermostat_states[room][STATE_DTIME]
+
+        # Every room carries the same pipe in reading
+        if not pipe_in_updated:
+            sensor_health.update(PIPE_IN_SENSOR, t, thermostat_states[room][STATE_PIPE_IN], any_boiler_on)
+            pipe_in_updated = True
+
+        sensor_health.update(room_sensor, t, thermostat_states[room][STATE_TEMPERATURE])
+        sensor_health.update(pipe_out_sensor, t, thermostat_states[room][STATE_PIPE_OUT], thermostat_states[room][STATE_BOILER])
+        sensor_health.update_pipe_relation(PIPE_IN_SENSOR, pipe_out_sensor, thermostat_states[room][STATE_BOILER])
+
+    # The control rules do not use pipe in. An untrusted pipe in sensor is only reported, it does not block every room.
+    for room in ROOMS:
+        trusted = all(sensor_health.is_trusted(sensor_name) for sensor_name in ROOM_SENSORS[room])
+        if trusted != thermostat_states[room][STATE_SENSOR_TRUSTED]:
+            log.critical(f"{room}: sensors {'trusted again' if trusted else 'no longer trusted'}")
+            journal.record(EVENT_SENSOR_HEALTH, room=room, trusted=trusted, sensors={sensor_name: sensor_health.is_trusted(sensor_name) for sensor_name in ROOM_SENSORS[room]})
+        thermostat_states[room][STATE_SENSOR_TRUSTED] = trusted
+
+
+def health_command(payload):
+    return sensor_health.metrics()
+
+
+def health_reset_command(payload):
+    if payload['sensor'] not in sensor_health.metrics():
+        return None
+
+    sensor_health.reset(payload['sensor'])
+    return sensor_health.metrics()[payload['sensor']]
+
+
+def update_thermal_models():
+    for room in ROOMS:
+        if thermostat_states[room][STATE_DATA_MISSING_COUNT] == 0 and thermostat_states[room][STATE_SENSOR_TRUSTED]:
+            thermal_models[room].update(thermostat_states[room][STATE_DTIME],
+                                        thermostat_states[room][STATE_TEMPERATURE],
+                                        thermostat_states[room][STATE_PIPE_OUT])
+        else:
+            thermal_models[room].reset_sample()
+
+
+def preheat_task():
+    global thermostat_states
+
+    # While heating, the boiler cycles pipe out between the low and high limits
+    pipe_out_heating = (thermostat_states[CONFIGURATIONS][CONFIG_PIPE_OUT_HIGH_LIMIT] + thermostat_states[CONFIGURATIONS][CONFIG_PIPE_OUT_LOW_LIMIT]) / 2
+
+    now = datetime.datetime.now()
+
+    for room in ROOMS:
+        state = thermostat_states[room]
+
+        if not state[STATE_AUTO_ON] or state[STATE_DATA_MISSING_COUNT] != 0 or not state[STATE_SENSOR_TRUSTED]:
+            state[STATE_AUTO_ON_LEAD_MINUTES] = None
+            continue
+
+        hour, minute = map(int, state[STATE_AUTO_ON_TIME].split(':'))
+        auto_on_time = now.replace(hour=hour, minute=minute, second=30, microsecond=0)
+        if auto_on_time <= now:
+            auto_on_time += datetime.timedelta(days=1)
+
+        lead_minutes = thermal_models[room].minutes_to_reach(state[STATE_TEMPERATURE], state[STATE_AUTO_ON_TARGET], pipe_out_heating)
+        state[STATE_AUTO_ON_LEAD_MINUTES] = lead_minutes
+
+        if lead_minutes is None or state[STATE_AUTO_ON_PREHEAT_FOR] == auto_on_time or state[STATE_TARGET] >= state[STATE_AUTO_ON_TARGET]:
+            continue
+
+        if now + datetime.timedelta(minutes=lead_minutes) >= auto_on_time:
+            log.info("{} Preheat {} minutes before auto_on_task at {}".format(room, lead_minutes, state[STATE_AUTO_ON_TIME]))
+            state[STATE_AUTO_ON_PREHEAT_FOR] = auto_on_time
+            state[STATE_TARGET] = state[STATE_AUTO_ON_TARGET]
+            journal.record(EVENT_CONFIG_CHANGE, room=room, source='preheat', target=state[STATE_TARGET], lead_minutes=lead_minutes)
 
 
 def update_boilers(new_onoffs):
@@ -214,14 +370,21 @@ def update_boilers(new_onoffs):
 
 def send_state_changes(old_onoffs, new_onoffs):
     with lock:
-        log.info("Calling change_states: {} -> {}".format(old_onoffs, new_onoffs))
+        start = time.monotonic()
         change_states(old_onoffs, new_onoffs)
+        journal.record(EVENT_ACTUATION, old=old_onoffs, new=new_onoffs, seconds=round(time.monotonic() - start, 2))
 
 
 @app.route('/')
 @app.route('/index')
 def index():
-    return render_template('index.html', **thermostat_states)
+    try:
+        states = current_states()
+    except (LookupError, sqlite3.Error) as e:
+        log.critical(f"Can't load controller state: {e}")
+        return "Controller state is not available", 503
+
+    return render_template('index.html', **states)
 
 
 @app.route('/check')
@@ -229,10 +392,100 @@ def check():
     return jsonify(tick=time.time())
 
 
+@app.route('/health')
+def health():
+    try:
+        sensors = run_control_command('health')
+    except ControlChannelError as e:
+        return str(e), 503
+
+    return jsonify(sensors=sensors)
+
+
+# Manually trusts a sensor again, e.g. after it was replaced
+@app.route('/health/reset', methods=['POST'])
+def health_reset():
+    try:
+        sensor = run_control_command('health_reset', {'sensor': request.form['sensor']})
+    except ControlChannelError as e:
+        return str(e), 503
+
+    if sensor is None:
+        return "Unknown sensor", 404
+
+    return jsonify(sensor=sensor)
+
+
 @app.route('/apply', methods=['POST', 'GET'])
 def apply():
     log.info("Apply: {}".format(request.form))
 
+    form = request.form.to_dict()
+
+    try:
+        run_control_command('apply', form)
+    except ControlCommandError as e:
+        log.critical(f"Apply failed: {e}")
+        return "Invalid settings: {}".format(e), 400
+    except ControlChannelError as e:
+        log.critical(f"Can't send apply to control process: {e}")
+        return "Control process is not available", 503
+
+    return redirect(url_for('index'))
+
+
+# The admin routes always diagnose the control process, also when they are served by a WSGI worker
+@app.route('/admin/profile')
+def admin_profile():
+    seconds = request.args.get('seconds', PROFILE_MAX_SECONDS, type=float)
+    interval = request.args.get('interval', PROFILE_DEFAULT_INTERVAL, type=float)
+
+    try:
+        stacks = run_control_command('profile', {'seconds': seconds, 'interval': interval})
+    except ControlChannelError as e:
+        return str(e), 503
+
+    if stacks is None:
+        stacks = "profiling started, call again to stop it and get the stacks\n"
+
+    return stacks, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+@app.route('/admin/tracemalloc')
+def admin_tracemalloc():
+    payload = {'limit': request.args.get('limit', 25, type=int), 'stop': request.args.get('stop', 0, type=int) != 0}
+
+    try:
+        diff = run_control_command('tracemalloc', payload)
+    except ControlChannelError as e:
+        return str(e), 503
+
+    return diff, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    try:
+        jobs = run_control_command('jobs')
+    except ControlChannelError as e:
+        return str(e), 503
+
+    return jsonify(jobs=jobs)
+
+
+def profile_command(payload):
+    return profile_toggle(payload['seconds'], payload['interval'])
+
+
+def tracemalloc_command(payload):
+    return tracemalloc_diff(payload['limit'], payload['stop'])
+
+
+def jobs_command(payload):
+    return job_run_recorder.job_table(scheduler) if scheduler else []
+
+
+def apply_form(form):
     global thermostat_states
 
     new_pipe_out_high_limit = thermostat_states[CONFIGURATIONS][CONFIG_PIPE_OUT_HIGH_LIMIT]
@@ -244,7 +497,7 @@ def apply():
     new_auto_on_time = {}
     new_auto_off = {room: False for room in ROOMS}
     new_auto_off_time = {}
-    for name, value in request.form.items():
+    for name, value in form.items():
         room_name, control_name = name.split("-")
         if control_name == "TARGET":
             new_targets[room_name] = float(value)
@@ -298,21 +551,19 @@ def apply():
             thermostat_states[room][STATE_AUTO_ON] = new_auto_on[room]
             thermostat_states[room][STATE_AUTO_ON_TIME] = new_auto_on_time[room]
 
-    # temperature_keeping_task()
+    journal.record(EVENT_CONFIG_CHANGE, source='apply', form=form)
 
-    return redirect(url_for('index'))
+    publish_states()
+
+    # temperature_keeping_task()
 
 
 def temperature_keeping_task():
-    log.info("TASK - Temperature Keeping Task")
-
     global thermostat_states
 
     pipe_out_high_limit = thermostat_states[CONFIGURATIONS][CONFIG_PIPE_OUT_HIGH_LIMIT]
     pipe_out_low_limit = thermostat_states[CONFIGURATIONS][CONFIG_PIPE_OUT_LOW_LIMIT]
 
-    TARGET_HIGH_MARGIN = 0.2
-
     boiler_state_change_delay = thermostat_states[CONFIGURATIONS][CONFIG_BOILER_STATE_CHANGE_DELAY]
     max_boiler_on_time = thermostat_states[CONFIGURATIONS][CONFIG_MAX_BOILER_ON_TIME]
 
@@ -321,23 +572,17 @@ def temperature_keeping_task():
     for room in ROOMS:
         boiler_state = thermostat_states[room][STATE_BOILER]
         target_base = thermostat_states[room][STATE_TARGET]
-        target_high = target_base + TARGET_HIGH_MARGIN
         data_missing = thermostat_states[room][STATE_DATA_MISSING_COUNT]
+        trusted = thermostat_states[room][STATE_SENSOR_TRUSTED]
         current = thermostat_states[room][STATE_TEMPERATURE]
         pipe_in = thermostat_states[room][STATE_PIPE_IN]
         pipe_out = thermostat_states[room][STATE_PIPE_OUT]
 
         time_passed_after_boiler_state_change = datetime.datetime.now() - thermostat_states[room][STATE_TIME_BOILER_CHANGE]
 
-        log.info("=== {:14} missing({:2}) current({:5.2f}) target({:5.2f}) in({:5.2f}) out({:5.2f}) boiler({}) tdelta({:.0f}min, {:.0f}sec)"
-                 .format(room, data_missing, current, target_base, pipe_in, pipe_out, str(boiler_state)[:1], *divmod(time_passed_after_boiler_state_change.total_seconds(), 60)))
-
         if boiler_state and \
-           (pipe_out >= pipe_out_high_limit or
-           current >= target_high or
-           time_passed_after_boiler_state_change >= max_boiler_on_time):
+           should_turn_off_boiler(current, target_base, pipe_out, time_passed_after_boiler_state_change, pipe_out_high_limit, max_boiler_on_time):
             # Turn off boiler
-            log.info("Should be OFF: current({:.2f}), target({:.2f}), out({:.2f}, tdelta({:.0f}min, {:.0f}sec))".format(current, target_base, pipe_out, *divmod(time_passed_after_boiler_state_change.total_seconds(), 60)))
             new_boiler_states[room] = False
 
             if room == ROOM_LIVING:
@@ -345,15 +590,22 @@ def temperature_keeping_task():
                 scheduler.add_job(prevent_possible_livingroom_out_of_sync, 'date', run_date=datetime.datetime.now() + datetime.timedelta(seconds=30))
                 scheduler.add_job(prevent_possible_livingroom_out_of_sync, 'date', run_date=datetime.datetime.now() + datetime.timedelta(seconds=90))
 
-        elif not boiler_state and \
-             (pipe_out < pipe_out_low_limit and
-             current < target_base and
-             time_passed_after_boiler_state_change >= boiler_state_change_delay and
-             data_missing == 0):
+        elif not boiler_state and trusted and \
+             should_turn_on_boiler(current, target_base, pipe_out, data_missing, time_passed_after_boiler_state_change, pipe_out_low_limit, boiler_state_change_delay):
             # Turn on boiler
-            log.info("Should be ON: current({:.2f}), target({:.2f}), out({:.2f}, tdelta({:.0f}min, {:.0f}sec))".format(current, target_base, pipe_out, *divmod(time_passed_after_boiler_state_change.total_seconds(), 60)))
             new_boiler_states[room] = True
-            pass
+
+        journal.record(EVENT_DECISION,
+                       room=room,
+                       missing=data_missing,
+                       trusted=trusted,
+                       current=current,
+                       target=target_base,
+                       pipe_in=pipe_in,
+                       pipe_out=pipe_out,
+                       boiler=boiler_state,
+                       new_boiler=new_boiler_states[room],
+                       seconds_since_change=round(time_passed_after_boiler_state_change.total_seconds()))
 
     send_state_changes([thermostat_states[room][STATE_BOILER] for room in ROOMS],
                        [new_boiler_states[room] for room in ROOMS])
@@ -446,11 +698,15 @@ def thermostat_recovery():
 def auto_off_task(room):
     log.info("{} Run auto_off_task. The next temperature_keeping_task will handle".format(room))
     thermostat_states[room][STATE_TARGET] = 5.0
+    journal.record(EVENT_CONFIG_CHANGE, room=room, source='auto_off', target=thermostat_states[room][STATE_TARGET])
+    publish_states()
 
 
 def auto_on_task(room):
     log.info("{} Run auto_on_task. The next temperature_keeping_task will handle".format(room))
     thermostat_states[room][STATE_TARGET] = thermostat_states[room][STATE_AUTO_ON_TARGET]
+    journal.record(EVENT_CONFIG_CHANGE, room=room, source='auto_on', target=thermostat_states[room][STATE_TARGET])
+    publish_states()
 
 
 def prevent_possible_livingroom_out_of_sync():
@@ -462,20 +718,36 @@ def prevent_possible_livingroom_out_of_sync():
             time.sleep(6.0)
 
 
+control_commands = {
+    'apply':        apply_form,
+    'profile':      profile_command,
+    'tracemalloc':  tracemalloc_command,
+    'jobs':         jobs_command,
+    'health':       health_command,
+    'health_reset': health_reset_command
+}
+
+
 if __name__ == '__main__':
     thermostat_states[ROOM_LIVING][STATE_BOILER]    = True if sys.argv[1].lower() == 't' else False
     thermostat_states[ROOM_BED][STATE_BOILER]       = True if sys.argv[2].lower() == 't' else False
     thermostat_states[ROOM_COMPUTER][STATE_BOILER]  = True if sys.argv[3].lower() == 't' else False
     thermostat_states[ROOM_HANS][STATE_BOILER]      = True if sys.argv[4].lower() == 't' else False
 
+    # 'control' runs only the control loop. The HTTP layer is then served by a multi-worker WSGI server from wsgi.py
+    control_only = len(sys.argv) > 5 and sys.argv[5].lower() == 'control'
+
     log = setup_logger(__name__, 'logs', 'thermostat.log')
     signal.signal(signal.SIGINT, signal_handler)
 
+    journal.open()
+
     gpio_init()
 
     scheduler = BackgroundScheduler(logger=log, executors={'default': ThreadPoolExecutor(1)})
 
     scheduler.add_listener(listen_to_apscheduler)
+    job_run_recorder.install(scheduler)
 
     initial_read_temperatures()
 
@@ -486,13 +758,31 @@ if __name__ == '__main__':
     scheduler.add_job(db_close, next_run_time=None, id='db_close', misfire_grace_time=None)
 
     scheduler.add_job(periodic_task,        'cron', second=0, minute='*', misfire_grace_time=15, coalesce=True)
-    scheduler.add_job(db_rollover,          'cron', second=45, minute=59, hour=8, misfire_grace_time=120)
+    scheduler.add_job(db_rollover,          'cron', second=DB_ROLLOVER_TIME.second, minute=DB_ROLLOVER_TIME.minute, hour=DB_ROLLOVER_TIME.hour, misfire_grace_time=120)
+
+    if control_only:
+        state_store = ThermostatStateStore()
+        state_store.open()
+        publish_states()
 
     scheduler.start()
 
-    try:
-        app.run(use_reloader=False, debug=True, host='0.0.0.0')
-    except FlaskStopException:
-        log.info("End of Flask app")
+    if control_only:
+        control_server = ControlServer(control_commands)
+        control_server.open()
+        try:
+            control_server.serve_forever()
+        except FlaskStopException:
+            log.info("End of control server")
+        finally:
+            control_server.close()
+            state_store.close()
+    else:
+        try:
+            app.run(use_reloader=False, debug=True, host='0.0.0.0')
+        except FlaskStopException:
+            log.info("End of Flask app")
+
+    journal.close()
 
     log.info("End of Program")
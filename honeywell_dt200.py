@@ -88,9 +88,9 @@ def rotate_rotary_encoder(count):
 
 
 def change_states(old_states, new_states):
-    log.info("State changes: {} -> {}".format(old_states, new_states))
+    log.debug("State changes: %s -> %s", old_states, new_states)
     for index, room in enumerate(_ROOMS):
-        log.info("=== {} ===".format(room))
+        log.debug("=== %s ===", room)
         if room == _LIVING_ROOM:
             if new_states[index] and not old_states[index]:
                 log.info("Turning ON")
@@ -113,7 +113,7 @@ def change_states(old_states, new_states):
         _press_button_short(_BUTTON_ROOM_SELECT)
         time.sleep(0.5)
 
-    log.info("========================")
+    log.debug("========================")
 
 
 if __name__ == '__main__':
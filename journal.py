@@ -0,0 +1,200 @@
+# Structured event journal of the control loop.
+#
+# record() only puts a tuple on a queue. A background thread writes the events as compact JSON lines to
+# journal/journal_YYYY-MM-DD.jsonl, gzips the finished days and removes the oldest days beyond the
+# retention limits. The control thread never formats or writes anything itself.
+#
+#   python journal.py --since 2026-01-05T20:00 --until 2026-01-05T23:00 --type D --room ROOM_BED
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+import traceback
+
+
+EVENT_SENSOR_READ = 'S'
+EVENT_DECISION = 'D'
+EVENT_ACTUATION = 'A'
+EVENT_CONFIG_CHANGE = 'C'
+EVENT_SENSOR_HEALTH = 'H'
+
+EVENT_TYPES = (EVENT_SENSOR_READ, EVENT_DECISION, EVENT_ACTUATION, EVENT_CONFIG_CHANGE, EVENT_SENSOR_HEALTH)
+
+
+JOURNAL_RETENTION_DAYS = 120
+JOURNAL_MAX_TOTAL_BYTES = 64 * 1024 * 1024
+JOURNAL_QUEUE_SIZE = 10000
+JOURNAL_BATCH_SIZE = 256
+
+
+def _json_default(value):
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+
+    return str(value)
+
+
+class EventJournal:
+    def __init__(self, journal_directory_name='journal', retention_days=JOURNAL_RETENTION_DAYS, max_total_bytes=JOURNAL_MAX_TOTAL_BYTES):
+        self._logger = logging.getLogger("thermostat")
+
+        self._journal_directory_name = journal_directory_name
+        self._retention_days = retention_days
+        self._max_total_bytes = max_total_bytes
+
+        self._queue = queue.Queue(maxsize=JOURNAL_QUEUE_SIZE)
+        self._thread = None
+        self._file = None
+        self._file_date = None
+
+        self.dropped = 0
+
+    def open(self):
+        try:
+            os.makedirs(self._journal_directory_name)
+        except FileExistsError:
+            pass
+
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+
+    def record(self, event_type, **fields):
+        try:
+            self._queue.put_nowait((time.time(), event_type, fields))
+        except queue.Full:
+            # Losing journal events is better than stalling the control loop on a slow SD card
+            self.dropped += 1
+
+    def close(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        running = True
+        while running:
+            events = [self._queue.get()]
+            while len(events) < JOURNAL_BATCH_SIZE:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in events:
+                running = False
+                events = [event for event in events if event is not None]
+
+            try:
+                self._write(events)
+            except Exception:
+                self._logger.info("## EventJournal: write failed\n{}".format(traceback.format_exc()))
+
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write(self, events):
+        for t, event_type, fields in events:
+            date = datetime.date.fromtimestamp(t)
+            if date != self._file_date:
+                self._switch_file(date)
+
+            self._file.write(json.dumps((round(t, 3), event_type, fields), separators=(',', ':'), default=_json_default))
+            self._file.write('\n')
+
+        if self._file:
+            self._file.flush()
+
+    def _switch_file(self, date):
+        if self._file:
+            self._file.close()
+
+        self._file_date = date
+        self._file = open(os.path.join(self._journal_directory_name, 'journal_{}.jsonl'.format(date.strftime('%Y-%m-%d'))), 'a')
+
+        self._compress_and_expire()
+
+    def _compress_and_expire(self):
+        current_file_name = 'journal_{}.jsonl'.format(self._file_date.strftime('%Y-%m-%d'))
+
+        for file_name in _journal_file_names(self._journal_directory_name):
+            if file_name.endswith('.jsonl') and file_name != current_file_name:
+                path = os.path.join(self._journal_directory_name, file_name)
+                with open(path, 'rb') as src, gzip.open(path + '.gz', 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(path)
+
+        expire_before = self._file_date - datetime.timedelta(days=self._retention_days)
+        file_names = _journal_file_names(self._journal_directory_name)
+        total_bytes = sum(os.path.getsize(os.path.join(self._journal_directory_name, file_name)) for file_name in file_names)
+
+        # Oldest first. The file being written is never removed.
+        for file_name in file_names:
+            if file_name == current_file_name:
+                break
+
+            if _journal_file_date(file_name) >= expire_before and total_bytes <= self._max_total_bytes:
+                break
+
+            path = os.path.join(self._journal_directory_name, file_name)
+            total_bytes -= os.path.getsize(path)
+            os.remove(path)
+
+
+def _journal_file_date(file_name):
+    return datetime.datetime.strptime(re.match(r'journal_(\d{4}-\d{2}-\d{2})\.jsonl', file_name).group(1), '%Y-%m-%d').date()
+
+
+def _journal_file_names(journal_directory_name):
+    return sorted(file_name for file_name in os.listdir(journal_directory_name) if re.fullmatch(r'journal_\d{4}-\d{2}-\d{2}\.jsonl(\.gz)?', file_name))
+
+
+def read_events(journal_directory_name='journal', since=None, until=None, event_types=None, room=None):
+    for file_name in _journal_file_names(journal_directory_name):
+        date = _journal_file_date(file_name)
+        if (since and date < since.date()) or (until and date > until.date()):
+            continue
+
+        path = os.path.join(journal_directory_name, file_name)
+        with (gzip.open(path, 'rt') if file_name.endswith('.gz') else open(path)) as f:
+            for line in f:
+                try:
+                    t, event_type, fields = json.loads(line)
+                except ValueError:
+                    # The last line may be partially written
+                    continue
+
+                if (since and t < since.timestamp()) or (until and t > until.timestamp()):
+                    continue
+                if event_types and event_type not in event_types:
+                    continue
+                if room and fields.get('room') != room:
+                    continue
+
+                yield t, event_type, fields
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Query the event journal')
+    parser.add_argument('--journal-dir', default='journal')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat, default=None, help='e.g. 2026-01-05T20:00')
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument('--type', action='append', choices=EVENT_TYPES, help='S(ensor read), D(ecision), A(ctuation), C(onfig change), H(sensor health)')
+    parser.add_argument('--room', default=None)
+    args = parser.parse_args(argv)
+
+    for t, event_type, fields in read_events(args.journal_dir, args.since, args.until, args.type, args.room):
+        print("{} {} {}".format(datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S'), event_type, json.dumps(fields, separators=(',', ':'))))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,164 @@
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_REMOVED
+
+
+PROFILE_MAX_SECONDS = 600
+PROFILE_DEFAULT_INTERVAL = 0.01
+PROFILE_MIN_INTERVAL = 0.005
+PROFILE_MAX_INTERVAL = 1.0
+TRACEMALLOC_FRAMES = 10
+JOB_RUN_HISTORY = 20
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+_profile_lock = threading.Lock()
+_profile_session = None
+
+
+def profile_toggle(seconds=PROFILE_MAX_SECONDS, interval=PROFILE_DEFAULT_INTERVAL):
+    # The first call starts sampling every other thread from a background thread, for at most 'seconds', and returns None.
+    # The next call stops the session and returns the stacks in the folded format of flamegraph.pl / speedscope:
+    # one 'thread;outer;...;inner count' line per distinct stack. No call waits for the sampling.
+    global _profile_session
+
+    with _profile_lock:
+        if _profile_session is None:
+            # Written as 'not >=' so that NaN from the query string is clamped too
+            if not interval >= PROFILE_MIN_INTERVAL:
+                interval = PROFILE_MIN_INTERVAL
+            if not seconds >= 0.0:
+                seconds = 0.0
+
+            stop = threading.Event()
+            stacks = collections.Counter()
+            thread = threading.Thread(target=_sample_stacks,
+                                      args=(min(seconds, PROFILE_MAX_SECONDS), min(interval, PROFILE_MAX_INTERVAL), stop, stacks),
+                                      name='profiler',
+                                      daemon=True)
+            _profile_session = (thread, stop, stacks)
+            thread.start()
+            return None
+
+        thread, stop, stacks = _profile_session
+        _profile_session = None
+
+    stop.set()
+    thread.join()
+
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+def _sample_stacks(seconds, interval, stop, stacks):
+    own_thread_id = threading.get_ident()
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            names.append(thread_names.get(thread_id, str(thread_id)))
+
+            stacks[';'.join(reversed(names))] += 1
+
+        if stop.wait(interval):
+            break
+
+
+_previous_snapshot = None
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+
+def tracemalloc_diff(limit=25, stop=False):
+    # The first call starts tracing and takes the baseline. Each next call returns the growth since the previous call.
+    global _previous_snapshot
+
+    if stop:
+        tracemalloc.stop()
+        _previous_snapshot = None
+        return "tracemalloc stopped\n"
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        _previous_snapshot = _take_snapshot()
+        return "tracemalloc started, call again for a diff against this baseline\n"
+
+    snapshot = _take_snapshot()
+    previous_snapshot = _previous_snapshot
+    _previous_snapshot = snapshot
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ["traced memory: current {:.1f} KiB, peak {:.1f} KiB".format(current / 1024, peak / 1024)]
+    lines.extend(str(stat) for stat in snapshot.compare_to(previous_snapshot, 'lineno')[:limit])
+
+    return '\n'.join(lines) + '\n'
+
+
+class JobRunRecorder:
+    # Keeps the last run durations of every APScheduler job. Durations are measured from submission to the
+    # executor until the job finished, so with a single worker thread they include the wait for the previous job.
+    # History is only kept for jobs that are still scheduled, so one-shot 'date' jobs do not accumulate.
+    def __init__(self):
+        self._scheduler = None
+        self._submitted = {}
+        self._runs = {}
+
+    def install(self, scheduler):
+        self._scheduler = scheduler
+        scheduler.add_listener(self._listen, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_REMOVED)
+
+    def _listen(self, event):
+        now = time.monotonic()
+
+        if event.code == EVENT_JOB_SUBMITTED:
+            self._submitted[event.job_id] = now
+            return
+
+        if event.code == EVENT_JOB_REMOVED:
+            self._runs.pop(event.job_id, None)
+            return
+
+        started = self._submitted.pop(event.job_id, None)
+
+        # A one-shot job is removed when it is submitted, before it finishes
+        if self._scheduler.get_job(event.job_id) is None:
+            self._runs.pop(event.job_id, None)
+            return
+
+        if event.code == EVENT_JOB_MISSED:
+            run = (event.scheduled_run_time.isoformat(), 'missed', None)
+        else:
+            run = (event.scheduled_run_time.isoformat(),
+                   'error' if event.code == EVENT_JOB_ERROR else 'ok',
+                   round(now - started, 3) if started is not None else None)
+
+        self._runs.setdefault(event.job_id, collections.deque(maxlen=JOB_RUN_HISTORY)).append(run)
+
+    def job_table(self, scheduler):
+        jobs = []
+        for job in scheduler.get_jobs():
+            jobs.append({'id': job.id,
+                         'name': job.name,
+                         'trigger': str(job.trigger),
+                         'next_run_time': job.next_run_time.isoformat() if job.next_run_time else None,
+                         'recent_runs': [{'scheduled_run_time': scheduled_run_time, 'result': result, 'seconds': seconds}
+                                         for scheduled_run_time, result, seconds in self._runs.get(job.id, ())]})
+
+        return jobs
@@ -0,0 +1,308 @@
+# Replays the boiler control rules over recorded days in db/ under a simulated clock.
+#
+#   python replay.py --since 2026-01-01 --until 2026-01-31 --high 33,35,37 --low 29,31 --max-on 10,15,20 --delay 3,5
+#
+# The room and pipe out temperatures are simulated (closed loop) by a simple plant fitted per room on the
+# whole replayed history by least squares: the room heat-up rate of the ThermalModel features and a
+# first-order pipe out response, towards the pipe in while the boiler is ON and towards the room while it
+# is OFF. When the simulated boiler is ON but the recorded one was OFF, the recorded pipe in is not heated
+# and the mean recorded pipe in while ON is used instead. The simulation is re-synchronised to the
+# recording after every gap in it. All metrics are computed on the simulated temperatures, so they depend
+# on the swept parameters. The fitted plant and its residual are printed to stderr per room.
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import itertools
+import math
+import sys
+from control_rules import (should_turn_off_boiler, should_turn_on_boiler, TARGET_HIGH_MARGIN,
+                           DEFAULT_BOILER_STATE_CHANGE_DELAY, DEFAULT_MAX_BOILER_ON_TIME, DEFAULT_PIPE_OUT_HIGH_LIMIT, DEFAULT_PIPE_OUT_LOW_LIMIT)
+from thermal_model import THERMAL_MODEL_MIN_SAMPLES
+from database import find_archived_db_files, read_room_columns
+
+
+# Rows further apart than this are a gap in the recording (data was missing, nothing was inserted)
+REPLAY_MAX_TICK_SECONDS = 90
+
+REPLAY_RESULT_COLUMNS = ('pipe_out_high_limit',
+                         'pipe_out_low_limit',
+                         'max_boiler_on_minutes',
+                         'boiler_state_change_delay_minutes',
+                         'room',
+                         'boiler_on_minutes',
+                         'switching_events',
+                         'outside_band_minutes',
+                         'below_band_idle_minutes',
+                         'above_band_heating_minutes')
+
+
+# Keeps the simulated temperatures within physically sensible bounds if a fitted model is poor
+REPLAY_ROOM_RANGE = (0.0, 40.0)
+REPLAY_PIPE_OUT_RANGE = (0.0, 90.0)
+
+
+_history = None
+_plants = None
+
+
+def load_history(db_file_paths):
+    # Concatenates each room over the day files, in recording order
+    history = {}
+    for db_file_path in db_file_paths:
+        for room_name, columns in read_room_columns(db_file_path).items():
+            room_history = history.setdefault(room_name, {column_name: [] for column_name in columns})
+            for column_name, values in columns.items():
+                room_history[column_name].extend(values)
+
+    return history
+
+
+def _ticks(columns):
+    # (t, dt or None after a gap, room, pipe_in, pipe_out, target, boiler_state, data_missing) of the complete rows
+    previous_t = None
+    for t, current, pipe_in, pipe_out, target, boiler_state, data_missing in zip(columns['date'],
+                                                                                 columns['current_temperature'],
+                                                                                 columns['current_pipe_in'],
+                                                                                 columns['current_pipe_out'],
+                                                                                 columns['target_temperature'],
+                                                                                 columns['boiler_state'],
+                                                                                 columns['data_missing']):
+        if current is None or pipe_in is None or pipe_out is None or target is None:
+            continue
+
+        dt = t - previous_t if previous_t is not None and t - previous_t <= REPLAY_MAX_TICK_SECONDS else None
+        previous_t = t
+
+        yield t, dt, current, pipe_in, pipe_out, target, boiler_state, data_missing
+
+
+def _room_features(room, pipe_out):
+    # Same features as the ThermalModel: rate [C/hour] = a + b * room + c * (pipe_out - room)
+    return (1.0, room, pipe_out - room)
+
+
+def _solve(a, b):
+    # Gaussian elimination with partial pivoting. None if the system is singular.
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(n)]
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(m[row][column]))
+        if abs(m[pivot][column]) < 1e-9:
+            return None
+        m[column], m[pivot] = m[pivot], m[column]
+        for row in range(column + 1, n):
+            factor = m[row][column] / m[column][column]
+            m[row] = [m[row][i] - factor * m[column][i] for i in range(n + 1)]
+
+    x = [0.0] * n
+    for row in reversed(range(n)):
+        x[row] = (m[row][n] - sum(m[row][i] * x[i] for i in range(row + 1, n))) / m[row][row]
+
+    return x
+
+
+def fit_plant(columns):
+    # Returns (room theta or None, room rate RMS residual in C/hour, room samples, mean pipe in while ON,
+    # pipe out rate constant while ON, while OFF), rate constants in 1/minute.
+    # Every sample has the same weight, unlike in the online ThermalModel whose forgetting factor only remembers the last hours.
+    n = len(_room_features(0.0, 0.0))
+    xx = [[0.0] * n for _ in range(n)]
+    xy = [0.0] * n
+    yy = 0.0
+    room_samples = 0
+
+    on_xy = on_xx = off_xy = off_xx = 0.0
+    pipe_in_on_sum = 0.0
+    pipe_in_on_samples = 0
+    previous = None
+    for t, dt, current, pipe_in, pipe_out, target, boiler_state, data_missing in _ticks(columns):
+        if boiler_state:
+            pipe_in_on_sum += pipe_in
+            pipe_in_on_samples += 1
+
+        if dt is not None and previous is not None:
+            previous_current, previous_pipe_in, previous_pipe_out = previous
+
+            x = _room_features(previous_current, previous_pipe_out)
+            room_rate = (current - previous_current) * 3600 / dt
+            for i in range(n):
+                xy[i] += x[i] * room_rate
+                for j in range(n):
+                    xx[i][j] += x[i] * x[j]
+            yy += room_rate * room_rate
+            room_samples += 1
+
+            pipe_out_rate = (pipe_out - previous_pipe_out) * 60 / dt
+            # A row is inserted before the tick's decision, so its boiler state is the one held over the interval up to it
+            if boiler_state:
+                x = previous_pipe_in - previous_pipe_out
+                on_xy += x * pipe_out_rate
+                on_xx += x * x
+            else:
+                x = previous_current - previous_pipe_out
+                off_xy += x * pipe_out_rate
+                off_xx += x * x
+
+        previous = (current, pipe_in, pipe_out)
+
+    theta = _solve(xx, xy) if room_samples >= THERMAL_MODEL_MIN_SAMPLES else None
+    # From the normal equations: sum of squared residuals = y.y - theta.(X^T y)
+    room_residual = math.sqrt(max(yy - sum(theta[i] * xy[i] for i in range(n)), 0.0) / room_samples) if theta else None
+
+    # A rate constant outside (0, 1] per minute is not a first-order response. Fall back to a slow one.
+    pipe_out_on_rate = min(max(on_xy / on_xx, 0.01), 1.0) if on_xx else 0.1
+    pipe_out_off_rate = min(max(off_xy / off_xx, 0.01), 1.0) if off_xx else 0.05
+    pipe_in_on = pipe_in_on_sum / pipe_in_on_samples if pipe_in_on_samples else None
+
+    return theta, room_residual, room_samples, pipe_in_on, pipe_out_on_rate, pipe_out_off_rate
+
+
+def replay_room(columns, plant, pipe_out_high_limit, pipe_out_low_limit, max_boiler_on_time, boiler_state_change_delay):
+    # Time values are seconds on the simulated clock
+    theta, room_residual, room_samples, pipe_in_on, pipe_out_on_rate, pipe_out_off_rate = plant
+
+    boiler_state = False
+    time_boiler_change = None
+    room = pipe_out = None
+
+    boiler_on_seconds = 0
+    switching_events = 0
+    outside_band_seconds = 0
+    below_band_idle_seconds = 0
+    above_band_heating_seconds = 0
+
+    for t, dt, current, pipe_in, recorded_pipe_out, target, recorded_boiler_state, data_missing in _ticks(columns):
+        if dt is None:
+            # Nothing is known about the gap: continue from the recording
+            dt = 0
+            room = current
+            pipe_out = recorded_pipe_out
+        else:
+            # Advance the plant over the interval with the state decided at the previous tick
+            minutes = dt / 60
+            # Without a room fit (less than THERMAL_MODEL_MIN_SAMPLES, or singular) falls back to the recorded room change
+            room_rate = sum(a * x for a, x in zip(theta, _room_features(room, pipe_out))) if theta else (current - previous_current) * 60 / minutes
+            if boiler_state:
+                supply = pipe_in if recorded_boiler_state or pipe_in_on is None else pipe_in_on
+                pipe_out += minutes * pipe_out_on_rate * (supply - pipe_out)
+            else:
+                pipe_out += minutes * pipe_out_off_rate * (room - pipe_out)
+            room += room_rate * minutes / 60
+
+            room = min(max(room, REPLAY_ROOM_RANGE[0]), REPLAY_ROOM_RANGE[1])
+            pipe_out = min(max(pipe_out, REPLAY_PIPE_OUT_RANGE[0]), REPLAY_PIPE_OUT_RANGE[1])
+
+        previous_current = current
+
+        if boiler_state:
+            boiler_on_seconds += dt
+
+        below_band = room < target
+        above_band = room >= target + TARGET_HIGH_MARGIN
+        if below_band or above_band:
+            outside_band_seconds += dt
+        if below_band and not boiler_state:
+            below_band_idle_seconds += dt
+        if above_band and boiler_state:
+            above_band_heating_seconds += dt
+
+        if time_boiler_change is None:
+            time_boiler_change = t - boiler_state_change_delay
+        time_passed_after_boiler_state_change = t - time_boiler_change
+
+        if boiler_state and \
+           should_turn_off_boiler(room, target, pipe_out, time_passed_after_boiler_state_change, pipe_out_high_limit, max_boiler_on_time):
+            boiler_state = False
+            time_boiler_change = t
+            switching_events += 1
+        elif not boiler_state and \
+             should_turn_on_boiler(room, target, pipe_out, data_missing, time_passed_after_boiler_state_change, pipe_out_low_limit, boiler_state_change_delay):
+            boiler_state = True
+            time_boiler_change = t
+            switching_events += 1
+
+    return (boiler_on_seconds / 60,
+            switching_events,
+            outside_band_seconds / 60,
+            below_band_idle_seconds / 60,
+            above_band_heating_seconds / 60)
+
+
+def _init_worker(history, plants):
+    global _history
+    global _plants
+
+    _history = history
+    _plants = plants
+
+
+def _replay_parameters(parameters):
+    pipe_out_high_limit, pipe_out_low_limit, max_boiler_on_minutes, boiler_state_change_delay_minutes = parameters
+
+    results = []
+    for room_name in sorted(_history):
+        result = replay_room(_history[room_name],
+                             _plants[room_name],
+                             pipe_out_high_limit,
+                             pipe_out_low_limit,
+                             max_boiler_on_minutes * 60,
+                             boiler_state_change_delay_minutes * 60)
+        results.append(parameters + (room_name,) + result)
+
+    return results
+
+
+def sweep(history, plants, parameter_grid, max_workers=None):
+    # The history and plants are sent once per worker process, not once per parameter set
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(history, plants)) as executor:
+        for results in executor.map(_replay_parameters, parameter_grid, chunksize=max(1, len(parameter_grid) // 64)):
+            yield from results
+
+
+def _float_list(value):
+    return [float(v) for v in value.split(',')]
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay the boiler control rules over recorded history')
+    parser.add_argument('--db-dir', default='db')
+    parser.add_argument('--since', type=_date, default=None, help='YYYY-MM-DD of the first day file')
+    parser.add_argument('--until', type=_date, default=None, help='YYYY-MM-DD of the last day file')
+    parser.add_argument('--include-current', action='store_true', help='Also replay the live thermostat.db')
+    parser.add_argument('--high', type=_float_list, default=[DEFAULT_PIPE_OUT_HIGH_LIMIT], help='CONFIG_PIPE_OUT_HIGH_LIMIT values')
+    parser.add_argument('--low', type=_float_list, default=[DEFAULT_PIPE_OUT_LOW_LIMIT], help='CONFIG_PIPE_OUT_LOW_LIMIT values')
+    parser.add_argument('--max-on', type=_float_list, default=[DEFAULT_MAX_BOILER_ON_TIME.total_seconds() / 60], help='CONFIG_MAX_BOILER_ON_TIME values in minutes')
+    parser.add_argument('--delay', type=_float_list, default=[DEFAULT_BOILER_STATE_CHANGE_DELAY.total_seconds() / 60], help='CONFIG_BOILER_STATE_CHANGE_DELAY values in minutes')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    db_file_paths = find_archived_db_files(args.db_dir, args.since, args.until, args.include_current)
+    if not db_file_paths:
+        parser.error("No day files found in {}".format(args.db_dir))
+
+    history = load_history(db_file_paths)
+    plants = {room_name: fit_plant(columns) for room_name, columns in history.items()}
+    for room_name, (theta, room_residual, room_samples, pipe_in_on, pipe_out_on_rate, pipe_out_off_rate) in sorted(plants.items()):
+        if theta:
+            room_fit = "rate = {:.3f} {:+.4f} * room {:+.4f} * (pipe_out - room) C/hour, RMS residual {:.2f} C/hour".format(*theta, room_residual)
+        else:
+            room_fit = "not fitted, replaying the recorded room temperature"
+        print("{}: {} samples, room {}, pipe out rate {:.3f}/minute ON {:.3f}/minute OFF, pipe in while ON {}".format(
+              room_name, room_samples, room_fit, pipe_out_on_rate, pipe_out_off_rate, 'n/a' if pipe_in_on is None else round(pipe_in_on, 1)),
+              file=sys.stderr)
+
+    parameter_grid = [parameters for parameters in itertools.product(args.high, args.low, args.max_on, args.delay) if parameters[1] < parameters[0]]
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(REPLAY_RESULT_COLUMNS)
+    for row in sweep(history, plants, parameter_grid, args.workers):
+        writer.writerow(row[:5] + tuple(round(value, 1) for value in row[5:]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+import math
+from sensor_map import *
+
+
+# Constant memory per sensor, O(1) work per sample. Nothing is read back from the database.
+
+SENSOR_HEALTH_EWMA_ALPHA = 0.05
+
+# Consecutive identical readings before a sensor is considered stuck. Pipe sensors only count readings
+# taken while water flows through the pipe, when a working sensor can not stay constant for long.
+SENSOR_HEALTH_FLAT_LINE_SAMPLES = {SENSOR_TYPE_DHT22: 180, SENSOR_TYPE_DS18B20: 30}
+
+# Faster changes in C/minute are physically implausible for the sensor position
+SENSOR_HEALTH_MAX_RATE = {SENSOR_TYPE_DHT22: 1.0, SENSOR_TYPE_DS18B20: 8.0}
+SENSOR_HEALTH_MAX_RATE_SAMPLES = 3
+
+# The return water of a room can not be much hotter than the supply water
+SENSOR_HEALTH_PIPE_OUT_OVER_IN_MARGIN = 3.0
+SENSOR_HEALTH_PIPE_OUT_OVER_IN_SAMPLES = 10
+
+
+def _sensor_types():
+    sensor_types = {}
+    for sensors in SENSOR_MAP.values():
+        for sensor in sensors:
+            for sensor_name, (sensor_type, _) in sensor.items():
+                sensor_types[sensor_name] = sensor_type
+
+    return sensor_types
+
+
+class SensorHealth:
+    def __init__(self, sensor_type):
+        self._flat_line_samples = SENSOR_HEALTH_FLAT_LINE_SAMPLES[sensor_type]
+        self._max_rate = SENSOR_HEALTH_MAX_RATE[sensor_type]
+
+        self.samples = 0
+        self.mean = None
+        self.variance = 0.0
+        self.zscore = 0.0
+        self.last_value = None
+        self.last_time = None
+        self.flat_line_count = 0
+        self.rate_violation_count = 0
+        self.rate_violations = 0
+        self.relation_violation_count = 0
+        self.relation_violations = 0
+
+    def update(self, t, value, flowing=True):
+        if self.mean is None:
+            self.mean = value
+        else:
+            # Incremental EWMA mean and variance
+            diff = value - self.mean
+            increment = SENSOR_HEALTH_EWMA_ALPHA * diff
+            self.zscore = diff / math.sqrt(self.variance) if self.variance > 0 else 0.0
+            self.mean += increment
+            self.variance = (1 - SENSOR_HEALTH_EWMA_ALPHA) * (self.variance + diff * increment)
+
+        if self.last_value is not None:
+            if value != self.last_value:
+                self.flat_line_count = 0
+            elif flowing:
+                self.flat_line_count += 1
+
+            minutes = (t - self.last_time).total_seconds() / 60
+            if minutes > 0 and abs(value - self.last_value) / minutes > self._max_rate:
+                self.rate_violation_count += 1
+                self.rate_violations += 1
+            else:
+                self.rate_violation_count = 0
+
+        self.last_value = value
+        self.last_time = t
+        self.samples += 1
+
+    def update_relation(self, consistent):
+        if consistent:
+            self.relation_violation_count = 0
+        else:
+            self.relation_violation_count += 1
+            self.relation_violations += 1
+
+    def decay_relation(self):
+        # Without flow the relation can not be checked. Decaying lets an untrusted room recover without heating.
+        self.relation_violation_count = max(self.relation_violation_count - 1, 0)
+
+    def reset(self):
+        self.flat_line_count = 0
+        self.rate_violation_count = 0
+        self.relation_violation_count = 0
+
+    def is_trusted(self):
+        return self.flat_line_count < self._flat_line_samples and \
+               self.rate_violation_count < SENSOR_HEALTH_MAX_RATE_SAMPLES and \
+               self.relation_violation_count < SENSOR_HEALTH_PIPE_OUT_OVER_IN_SAMPLES
+
+    def metrics(self):
+        return {'trusted': self.is_trusted(),
+                'samples': self.samples,
+                'last_value': self.last_value,
+                'ewma_mean': self.mean,
+                'ewma_stddev': math.sqrt(self.variance),
+                'zscore': self.zscore,
+                'flat_line_count': self.flat_line_count,
+                'rate_violations': self.rate_violations,
+                'relation_violations': self.relation_violations}
+
+
+class SensorHealthMonitor:
+    def __init__(self):
+        self._sensors = {sensor_name: SensorHealth(sensor_type) for sensor_name, sensor_type in _sensor_types().items()}
+
+    def update(self, sensor_name, t, value, flowing=True):
+        self._sensors[sensor_name].update(t, value, flowing)
+
+    def update_pipe_relation(self, pipe_in_sensor_name, pipe_out_sensor_name, boiler_on):
+        # Only meaningful while the room's valve is open and water flows from the supply to the return pipe
+        if not boiler_on:
+            self._sensors[pipe_out_sensor_name].decay_relation()
+            return
+
+        # A faulty pipe in sensor would otherwise be blamed on every pipe out sensor
+        if not self._sensors[pipe_in_sensor_name].is_trusted():
+            return
+
+        pipe_in = self._sensors[pipe_in_sensor_name].last_value
+        pipe_out = self._sensors[pipe_out_sensor_name].last_value
+        if pipe_in is not None and pipe_out is not None:
+            self._sensors[pipe_out_sensor_name].update_relation(pipe_out <= pipe_in + SENSOR_HEALTH_PIPE_OUT_OVER_IN_MARGIN)
+
+    def reset(self, sensor_name):
+        self._sensors[sensor_name].reset()
+
+    def is_trusted(self, sensor_name):
+        return self._sensors[sensor_name].is_trusted()
+
+    def metrics(self):
+        return {sensor_name: sensor.metrics() for sensor_name, sensor in self._sensors.items()}
@@ -0,0 +1,53 @@
+import datetime
+import random
+from thermal_model import ThermalModel, THERMAL_MODEL_FEATURES, THERMAL_MODEL_MAX_COVARIANCE_TRACE, THERMAL_MODEL_FORGETTING_FACTOR
+
+
+def _true_rate(room, pipe_out):
+    # C/hour: 5 C outside, loss 0.1/hour, gain 0.15/hour from the pipe out
+    return 0.1 * (5.0 - room) + 0.15 * (pipe_out - room)
+
+
+def _run_closed_loop(model, days, seed):
+    # Per-minute ticks at sensor resolution: room in 0.1 C (DHT22), pipe out in 1/16 C (DS18B20)
+    rng = random.Random(seed)
+    t = datetime.datetime(2026, 1, 1)
+    room, pipe_out, boiler_on = 20.0, 20.0, False
+
+    for _ in range(days * 24 * 60):
+        model.update(t, round(room, 1), round(pipe_out * 16) / 16)
+
+        if boiler_on and room > 22.2:
+            boiler_on = False
+        elif not boiler_on and room < 21.8:
+            boiler_on = True
+
+        rate = _true_rate(room, pipe_out) + rng.gauss(0.0, 0.05)
+        pipe_out += 0.3 * (50.0 - pipe_out) if boiler_on else 0.1 * (room - pipe_out)
+        room += rate / 60
+        t += datetime.timedelta(minutes=1)
+
+
+def test_covariance_stays_bounded_over_a_month():
+    for seed in range(2):
+        model = ThermalModel()
+        _run_closed_loop(model, 30, seed)
+
+        p = model._p
+        assert all(p[i][i] > 0.0 for i in range(THERMAL_MODEL_FEATURES))
+        assert sum(p[i][i] for i in range(THERMAL_MODEL_FEATURES)) <= THERMAL_MODEL_MAX_COVARIANCE_TRACE / THERMAL_MODEL_FORGETTING_FACTOR
+        assert all(p[i][j] == p[j][i] for i in range(THERMAL_MODEL_FEATURES) for j in range(THERMAL_MODEL_FEATURES))
+
+        assert model.is_trained()
+        for room, pipe_out in ((22.0, 23.0), (22.0, 45.0)):
+            assert abs(model.heat_up_rate(room, pipe_out) - _true_rate(room, pipe_out)) < 0.2
+
+
+def test_implausible_fit_is_not_trained():
+    model = ThermalModel()
+    _run_closed_loop(model, 1, 0)
+    assert model.is_trained()
+
+    model._theta = [-8765.0, 471.0, 4.0]
+    assert not model.is_trained()
+    assert model.minutes_to_reach(21.0, 22.0, 40.0) is None
@@ -0,0 +1,112 @@
+import math
+
+
+# Per-room heat-up rate model, updated once per tick by recursive least squares:
+#
+#   rate [C/hour] = a + b * room + c * (pipe_out - room)
+#
+# There is no outdoor sensor. Heat loss is proportional to (room - outside) and the outside temperature
+# changes slowly compared to the forgetting window, so the loss ends up in a + b * room.
+
+THERMAL_MODEL_FEATURES = 3
+THERMAL_MODEL_FORGETTING_FACTOR = 0.998
+THERMAL_MODEL_INITIAL_COVARIANCE = 1000.0
+THERMAL_MODEL_MAX_COVARIANCE_TRACE = 10000.0
+THERMAL_MODEL_MAX_RATE = 10.0                   # C/hour. A room heating or cooling faster than this is a bad fit.
+THERMAL_MODEL_MIN_SAMPLES = 120                 # About two hours of per-minute readings
+THERMAL_MODEL_MIN_SAMPLE_SECONDS = 30
+THERMAL_MODEL_MAX_SAMPLE_SECONDS = 120
+
+
+def _features(room, pipe_out):
+    return (1.0, room, pipe_out - room)
+
+
+def _initial_covariance():
+    return [[THERMAL_MODEL_INITIAL_COVARIANCE if i == j else 0.0 for j in range(THERMAL_MODEL_FEATURES)] for i in range(THERMAL_MODEL_FEATURES)]
+
+
+class ThermalModel:
+    def __init__(self, forgetting_factor=THERMAL_MODEL_FORGETTING_FACTOR):
+        self._forgetting_factor = forgetting_factor
+        self._theta = [0.0] * THERMAL_MODEL_FEATURES
+        self._p = _initial_covariance()
+        self._previous_sample = None
+        self._last_x = None
+
+        self.samples = 0
+
+    def update(self, t, room, pipe_out):
+        previous_sample = self._previous_sample
+        self._previous_sample = (t, room, pipe_out)
+
+        if previous_sample is None:
+            return
+
+        previous_t, previous_room, previous_pipe_out = previous_sample
+        seconds = (t - previous_t).total_seconds()
+        if not THERMAL_MODEL_MIN_SAMPLE_SECONDS <= seconds <= THERMAL_MODEL_MAX_SAMPLE_SECONDS:
+            return
+
+        self._update_rls(_features(previous_room, previous_pipe_out), (room - previous_room) * 3600.0 / seconds)
+
+    def reset_sample(self):
+        # A missing reading breaks the rate between two consecutive samples
+        self._previous_sample = None
+
+    def _update_rls(self, x, y):
+        n = THERMAL_MODEL_FEATURES
+        p = self._p
+        lam = self._forgetting_factor
+
+        px = [sum(p[i][j] * x[j] for j in range(n)) for i in range(n)]
+        denominator = lam + sum(x[i] * px[i] for i in range(n))
+        k = [px[i] / denominator for i in range(n)]
+
+        error = y - sum(self._theta[i] * x[i] for i in range(n))
+        self._theta = [self._theta[i] + k[i] * error for i in range(n)]
+
+        # P is symmetric, so x^T P == (P x)^T. Roundoff breaks the symmetry, and over weeks of ticks an asymmetric P
+        # becomes indefinite and the estimate diverges, so it is symmetrised after every step.
+        p = [[p[i][j] - k[i] * px[j] for j in range(n)] for i in range(n)]
+        p = [[(p[i][j] + p[j][i]) / 2 for j in range(n)] for i in range(n)]
+
+        # Without excitation (e.g. the boiler stays off all day) dividing by lambda winds P up without bound
+        trace = sum(p[i][i] for i in range(n))
+        if trace < THERMAL_MODEL_MAX_COVARIANCE_TRACE:
+            p = [[p[i][j] / lam for j in range(n)] for i in range(n)]
+
+        # A covariance with a non-positive variance or outside the trace bound is broken. Restart it, keep theta.
+        if not all(p[i][i] > 0.0 for i in range(n)) or not 0.0 < trace <= THERMAL_MODEL_MAX_COVARIANCE_TRACE / lam:
+            p = _initial_covariance()
+
+        self._p = p
+        self._last_x = x
+        self.samples += 1
+
+    def is_trained(self):
+        # Also rejects a fit that predicts an implausible rate at the last sample
+        return self.samples >= THERMAL_MODEL_MIN_SAMPLES and \
+               all(math.isfinite(v) for v in self._theta) and \
+               abs(sum(theta * x for theta, x in zip(self._theta, self._last_x))) <= THERMAL_MODEL_MAX_RATE
+
+    def heat_up_rate(self, room, pipe_out):
+        return sum(theta * x for theta, x in zip(self._theta, _features(room, pipe_out)))
+
+    def minutes_to_reach(self, current, target, pipe_out, max_minutes=180):
+        # Integrates the model one minute at a time. None if untrained or the target is not reachable in max_minutes.
+        if not self.is_trained():
+            return None
+
+        room = current
+        for minute in range(max_minutes + 1):
+            if room >= target:
+                return minute
+
+            rate = self.heat_up_rate(room, pipe_out)
+            if rate <= 0.0:
+                return None
+
+            room += rate / 60.0
+
+        return None
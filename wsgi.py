@@ -0,0 +1,10 @@
+# Entry point for a multi-worker WSGI server, e.g.
+#   python flask_app.py t f f f control
+#   gunicorn -w 4 -b 0.0.0.0:5000 wsgi:app
+# Workers read the controller state from db/state.db and forward commands to the control process.
+import flask_app
+
+
+flask_app.init_worker()
+
+app = flask_app.app